@@ -0,0 +1,26 @@
+import os
+
+# under pytest-xdist each worker would default to one intra-op thread per core, oversubscribing the cpu across workers
+# pin workers to a single thread - the env vars must be set before torch is first imported
+
+if 'PYTEST_XDIST_WORKER' in os.environ:
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    os.environ.setdefault('MKL_NUM_THREADS', '1')
+
+import torch
+
+if 'PYTEST_XDIST_WORKER' in os.environ:
+    torch.set_num_threads(1)
+
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--full-matrix',
+        action = 'store_true',
+        default = False,
+        help = 'run the full cartesian product of parametrized hyperparameters instead of the pairwise subset'
+    )
@@ -1,17 +1,50 @@
-from titans_pytorch.neural_memory import (
-    NeuralMemory,
-)
+# submodules are imported lazily on first attribute access (PEP 562), so that importing a single class does not pull in the rest
 
-from titans_pytorch.memory_models import (
-    MemoryMLP,
-    MemoryAttention,
-    FactorizedMemoryMLP,
-    MemorySwiGluMLP,
-    GatedResidualMemoryMLP,
-    QuantizedMemoryAttention,
-    QuantizedMemoryMLP
-)
+from importlib import import_module
+from typing import TYPE_CHECKING
+
+# explicit imports for static analysers and IDEs, never executed at runtime
+
+if TYPE_CHECKING:
+    from titans_pytorch.neural_memory import (
+        NeuralMemory,
+    )
+
+    from titans_pytorch.memory_models import (
+        MemoryMLP,
+        MemoryAttention,
+        FactorizedMemoryMLP,
+        MemorySwiGluMLP,
+        GatedResidualMemoryMLP,
+        QuantizedMemoryAttention,
+        QuantizedMemoryMLP
+    )
 
-from titans_pytorch.mac_transformer import (
-    MemoryAsContextTransformer
+    from titans_pytorch.mac_transformer import (
+        MemoryAsContextTransformer
+    )
+
+_LAZY = dict(
+    NeuralMemory = 'titans_pytorch.neural_memory',
+    MemoryMLP = 'titans_pytorch.memory_models',
+    MemoryAttention = 'titans_pytorch.memory_models',
+    FactorizedMemoryMLP = 'titans_pytorch.memory_models',
+    MemorySwiGluMLP = 'titans_pytorch.memory_models',
+    GatedResidualMemoryMLP = 'titans_pytorch.memory_models',
+    QuantizedMemoryAttention = 'titans_pytorch.memory_models',
+    QuantizedMemoryMLP = 'titans_pytorch.memory_models',
+    MemoryAsContextTransformer = 'titans_pytorch.mac_transformer'
 )
+
+__all__ = list(_LAZY)
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+    value = getattr(import_module(_LAZY[name]), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted({*globals(), *_LAZY})